@@ -3,4 +3,11 @@
 __version__ = '0.2.4'
 
 from .types import *
-from .main import start
+
+
+def __getattr__(name):
+    # Imported lazily to keep ``import remote_email_filtering`` cheap
+    if name == 'start':
+        from .main import start
+        return start
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -32,6 +32,29 @@ class Action(abc.ABC):
         pass
 
 
+class BatchAction(Action):
+    """
+    An :class:`Action` that processes a batch of :class:`~.message.Message` s
+    at once.
+
+    :func:`~.main.pipeline_batch` calls :meth:`process_batch` once with every
+    message of a fetched batch whose pipeline reached this action, so that
+    lookups or scoring can be amortized over the batch.
+    """
+
+    @abc.abstractmethod
+    def process_batch(self, msgs) -> 'List[Iterable[Action]]':
+        """
+        Return an iterable of further :class:`Action` s for each message in
+        ``msgs``, in the same order. Include :class:`Stop` to stop processing
+        a message.
+        """
+        pass
+
+    def __call__(self, msg):
+        return self.process_batch([msg])[0]
+
+
 class Stop(Action):
     """
     Stop processing any futher :class:`Action` for the current
@@ -42,6 +65,36 @@ class Stop(Action):
         raise StopIteration()
 
 
+class Deduplicate(Action):
+    def __init__(self, index, then=None):
+        """
+        Apply ``then`` to copies of a :class:`~.message.Message` that has
+        already been seen in another location, and record other messages as
+        the canonical copy.
+
+        A canonical copy that is deleted or moved by another client is
+        forgotten only when :func:`~.main.start` lists its directory again,
+        which it does for the directories it applies actions to. Until then,
+        or if the canonical copy was in another directory, the other copies
+        are still treated as duplicates.
+
+        :param index: a :class:`~.dedup.MessageIndex`
+        :param then: :class:`Action` s to apply to duplicates, defaults to
+           :class:`Stop`
+        """
+        super().__init__()
+        self.index = index
+        self.then = [Stop()] if then is None else list(then)
+
+    def __call__(self, msg):
+        if self.index.is_duplicate(msg):
+            log.info(f'{msg.dir_}/{msg.Subject} is a duplicate of '
+                     f'{self.index.location(msg)}')
+            return list(self.then)
+        self.index.claim(msg)
+        return []
+
+
 class Move(Action):
     def __init__(self, destination: tuple[str]):
         """
@@ -87,3 +140,42 @@ class ChangeFlags(Action):
         msg._flags = new_flags
         log.info(f'{msg.dir_}/{msg.Subject} =({msg.flags})')
         return []
+
+
+class Archive(BatchAction):
+    def __init__(self, path, format='maildir', then=(),
+                 segment_size=1 << 30, chunk_size=1 << 20):
+        """
+        Stream the raw :class:`~.message.Message` to local storage without
+        parsing it.
+
+        Each batch is synced to disk before the actions in ``then`` are
+        applied, so e.g. ``then=[Move(('Archived',))]`` only moves messages
+        that are safely stored.
+
+        :param str path: the Maildir, mbox file or segment directory
+        :param str format: ``'maildir'``, ``'mbox'`` or ``'mbox.gz'`` for
+           gzip compressed mbox segments of ``segment_size`` bytes
+        :param then: :class:`Action` s to apply to each archived message
+        :param int chunk_size: bytes fetched and written at a time
+        """
+        super().__init__()
+        from . import archive
+        if format == 'maildir':
+            self.store = archive.Maildir(path)
+        elif format == 'mbox':
+            self.store = archive.Mbox(path)
+        elif format == 'mbox.gz':
+            self.store = archive.Mbox(path, compress=True,
+                                      segment_size=segment_size)
+        else:
+            raise ValueError(f"Unknown archive format {format}")
+        self.then = list(then)
+        self.chunk_size = chunk_size
+
+    def process_batch(self, msgs):
+        with self.store.batch(self.chunk_size) as add:
+            for msg in msgs:
+                log.info(f'Archiving {msg.dir_}/{msg.Subject}')
+                add(msg)
+        return [list(self.then) for _ in msgs]
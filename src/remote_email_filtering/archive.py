@@ -0,0 +1,186 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+"""
+Local storage for archived messages, used by :class:`~.action.Archive`.
+
+Messages are streamed to disk in chunks without being parsed. Each store
+writes a batch of messages and makes it durable with as few ``fsync`` as
+possible before the batch is reported as stored.
+"""
+import contextlib
+import datetime
+import gzip
+import itertools
+import os
+import re
+import socket
+import time
+
+
+def write_message(msg, fp, chunk_size=1 << 20):
+    """
+    Write the raw bytes of ``msg`` to ``fp``, streaming them from the
+    :class:`~.remote.Remote` unless they have already been fetched.
+    """
+    if msg.raw is None:
+        return msg.remote.stream_body(msg.uid, fp, chunk_size)
+    raw = memoryview(msg.raw)
+    for offset in range(0, len(raw), chunk_size):
+        fp.write(raw[offset:offset + chunk_size])
+    return len(raw)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Maildir(object):
+    """
+    Store messages as files in a Maildir.
+    """
+    _counter = itertools.count()
+
+    def __init__(self, path):
+        self.path = path
+        for sub in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+
+    def _unique(self):
+        return (f'{time.time_ns()}.P{os.getpid()}Q{next(self._counter)}.'
+                f'{socket.gethostname()}')
+
+    @contextlib.contextmanager
+    def batch(self, chunk_size=1 << 20):
+        """
+        Context manager yielding a function that adds a message to the
+        batch. Messages become visible in ``new/`` only after all of them
+        have been written and synced.
+
+        Each file is synced and closed as soon as it is written, so that a
+        batch holds a single file open at a time.
+        """
+        written = []
+
+        def add(msg):
+            name = self._unique()
+            tmp = os.path.join(self.path, 'tmp', name)
+            written.append((tmp, os.path.join(self.path, 'new', name)))
+            with open(tmp, 'wb') as fp:
+                write_message(msg, fp, chunk_size)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+        try:
+            yield add
+            for tmp, new in written:
+                os.rename(tmp, new)
+            _fsync_dir(os.path.join(self.path, 'new'))
+        except BaseException:
+            for tmp, _ in written:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(tmp)
+            raise
+
+
+class _MboxBody(object):
+    """
+    Writes a message streamed in chunks as an mboxrd entry: line endings are
+    converted to LF and ``From`` lines are quoted.
+    """
+    FROM_LINE = re.compile(rb'^(>*From )', re.MULTILINE)
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.partial = b''
+
+    def _write_lines(self, lines):
+        lines = lines.replace(b'\r\n', b'\n')
+        self.fp.write(self.FROM_LINE.sub(rb'>\1', lines))
+
+    def write(self, data):
+        size = len(data)
+        data = self.partial + bytes(data)
+        lines, newline, self.partial = data.rpartition(b'\n')
+        if newline:
+            self._write_lines(lines + newline)
+        return size
+
+    def close(self):
+        if self.partial:
+            self._write_lines(self.partial + b'\n')
+        self.partial = b''
+        self.fp.write(b'\n')
+
+
+class Mbox(object):
+    """
+    Append messages to mbox files, optionally as gzip compressed segments.
+
+    With ``compress`` every batch is appended as a separate gzip member and
+    a new segment file is started once the current one exceeds
+    ``segment_size`` bytes.
+    """
+    def __init__(self, path, compress=False, segment_size=1 << 30):
+        """
+        :param str path: the mbox file, or a directory of segments if
+           ``compress`` is set
+        """
+        self.path = path
+        self.compress = compress
+        self.segment_size = segment_size
+        if compress:
+            os.makedirs(path, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _segment(self):
+        segments = sorted(name for name in os.listdir(self.path)
+                          if name.endswith('.mbox.gz'))
+        n = 0
+        if segments:
+            n = int(segments[-1].split('.')[0])
+            if (os.path.getsize(os.path.join(self.path, segments[-1]))
+                    >= self.segment_size):
+                n += 1
+        return os.path.join(self.path, f'{n:06d}.mbox.gz')
+
+    @staticmethod
+    def _from_line(msg):
+        when = msg.Time
+        if not isinstance(when, datetime.datetime):
+            when = datetime.datetime.now(datetime.timezone.utc)
+        return f'From MAILER-DAEMON {when.strftime("%a %b %d %H:%M:%S %Y")}\n'
+
+    @contextlib.contextmanager
+    def batch(self, chunk_size=1 << 20):
+        """
+        Context manager yielding a function that adds a message to the
+        batch. The batch is synced once; on failure the file is truncated
+        back to where the batch started.
+        """
+        path = self._segment() if self.compress else self.path
+        with open(path, 'ab') as fp:
+            start = fp.tell()
+            out = gzip.GzipFile(fileobj=fp, mode='wb') if self.compress else fp
+
+            def add(msg):
+                out.write(self._from_line(msg).encode('ascii'))
+                body = _MboxBody(out)
+                write_message(msg, body, chunk_size)
+                body.close()
+
+            try:
+                yield add
+                if self.compress:
+                    out.close()
+                fp.flush()
+                os.fsync(fp.fileno())
+            except BaseException:
+                if self.compress:
+                    out.close()
+                fp.truncate(start)
+                raise
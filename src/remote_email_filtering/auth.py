@@ -1,6 +1,7 @@
 # Copyright 2022, Gaurav Juvekar
 # SPDX-License-Identifier: MIT
 import base64
+import datetime
 
 
 class XOauth2(object):
@@ -9,3 +10,48 @@ class XOauth2(object):
 
     def authenticate_imap(self):
         return lambda _: self.xoauth2_string
+
+
+class Token(object):
+    """
+    An OAuth2 access token that is refreshed before it expires.
+    """
+    def __init__(self, provider, margin=datetime.timedelta(minutes=5)):
+        """
+        :param provider: a static access token ``str``, or a callable
+           returning a tuple ``(access_token, expiry)`` where ``expiry`` is
+           an aware :class:`~datetime.datetime` or ``None`` if unknown
+        :param margin: refresh this long before ``expiry``
+        """
+        self.provider = provider
+        self.margin = margin
+        self._token = None
+        self.expiry = None
+        if not callable(provider):
+            self._token = provider
+
+    def expiring(self):
+        """
+        ``True`` if the token must be refreshed before its next use.
+        """
+        if not callable(self.provider):
+            return False
+        if self._token is None:
+            return True
+        if self.expiry is None:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self.expiry - self.margin <= now
+
+    def refresh(self):
+        if callable(self.provider):
+            self._token, self.expiry = self.provider()
+        return self._token
+
+    def get(self):
+        """
+        Get a valid access token, refreshing it if required.
+        """
+        if self.expiring():
+            return self.refresh()
+        return self._token
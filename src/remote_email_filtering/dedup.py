@@ -0,0 +1,205 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+"""
+Index of messages by Message-ID, used to find copies of the same message in
+several directories and to skip messages that have already been evaluated.
+"""
+import hashlib
+import logging
+import os
+import pickle
+
+from . import types
+
+log = logging.getLogger(__name__)
+
+_LOCAL_BITS = 32
+_DIR_BITS = 16
+_LOCAL_MASK = (1 << _LOCAL_BITS) - 1
+_DIR_MASK = (1 << _DIR_BITS) - 1
+
+
+def _digest(message_id):
+    if isinstance(message_id, str):
+        message_id = message_id.encode('utf-8', errors='replace')
+    message_id = message_id.strip()
+    if not message_id:
+        return None
+    return int.from_bytes(hashlib.blake2b(message_id, digest_size=8).digest(),
+                          'little')
+
+
+def _local(uid):
+    # IMAP uids are 32 bit, EWS item ids are hashed down to 32 bits
+    local = types.uid_key(uid)
+    if isinstance(local, int):
+        return local & _LOCAL_MASK
+    if isinstance(local, str):
+        local = local.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(local, digest_size=4).digest(),
+                          'little')
+
+
+class MessageIndex(object):
+    """
+    Maps the Message-ID of each message to its canonical location: the
+    directory and local id (see :func:`~.types.uid_key`) of the first copy
+    seen, and the directory whose :class:`~.action.Action` s have been
+    applied to it. Local ids stay the same when a message is modified, e.g.
+    when its flags change.
+
+    Each entry is a single int keyed by the 64 bit hash of the Message-ID,
+    packing the interned directories and the 32 bit IMAP uid or a 32 bit hash
+    of the EWS item id. Up to 65535 directories are indexed.
+
+    Entries are evicted approximately least recently used: they are kept in
+    two generations of ``max_entries / 2``. When the recent generation is
+    full it becomes the old one and the previous old generation is dropped.
+    Entries of the old generation are moved back to the recent one when they
+    are looked up.
+    """
+    def __init__(self, path=None, max_entries=1_000_000):
+        """
+        :param str path: file to load the index from and :meth:`save` it to.
+           The index is kept in memory only if ``None``.
+        :param int max_entries: number of messages to remember
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self._recent = dict()
+        self._old = dict()
+        self._dirs = []
+        self._dir_ids = dict()
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self._dirs, self._recent, self._old = pickle.load(f)
+            self._dir_ids = dict((d, i) for i, d in enumerate(self._dirs))
+
+    def __len__(self):
+        return len(self._recent) + len(self._old)
+
+    def _dir_id(self, dir_):
+        if dir_ not in self._dir_ids:
+            if len(self._dirs) >= _DIR_MASK:
+                raise ValueError(f'Too many directories to index {dir_}')
+            self._dir_ids[dir_] = len(self._dirs)
+            self._dirs.append(dir_)
+        return self._dir_ids[dir_]
+
+    def _get(self, msg):
+        key = _digest(msg.envelope.get('message_id') or b'')
+        if key is None:
+            return None, None
+        entry = self._recent.get(key)
+        if entry is None:
+            entry = self._old.pop(key, None)
+            if entry is not None:
+                self._store(key, entry)
+        return key, entry
+
+    def _store(self, key, entry):
+        if len(self._recent) >= max(self.max_entries // 2, 1):
+            self._old = self._recent
+            self._recent = dict()
+        self._recent[key] = entry
+
+    def _put(self, key, dir_, uid, decided):
+        decided = 0 if decided is None else self._dir_id(decided) + 1
+        self._old.pop(key, None)
+        self._store(key, (decided << (_DIR_BITS + _LOCAL_BITS)
+                          | self._dir_id(dir_) << _LOCAL_BITS
+                          | _local(uid)))
+
+    def _drop(self, key):
+        self._recent.pop(key, None)
+        self._old.pop(key, None)
+
+    def _at(self, entry, dir_, uid):
+        # Compare stable ids only, an EWS changekey changes with every edit
+        return (entry >> _LOCAL_BITS & _DIR_MASK == self._dir_ids.get(dir_)
+                and entry & _LOCAL_MASK == _local(uid))
+
+    def _decided(self, entry):
+        decided = entry >> (_DIR_BITS + _LOCAL_BITS)
+        return None if decided == 0 else self._dirs[decided - 1]
+
+    def location(self, msg):
+        """
+        The directory of the canonical copy of ``msg``, or ``None`` if it
+        has not been seen.
+        """
+        _, entry = self._get(msg)
+        if entry is None:
+            return None
+        return self._dirs[entry >> _LOCAL_BITS & _DIR_MASK]
+
+    def is_duplicate(self, msg):
+        """
+        ``True`` if another copy of ``msg`` is the canonical one.
+        """
+        _, entry = self._get(msg)
+        return entry is not None and not self._at(entry, msg.dir_, msg.uid)
+
+    def claim(self, msg):
+        """
+        Record ``msg`` as the canonical copy if none is known yet.
+        """
+        key, entry = self._get(msg)
+        if key is not None and entry is None:
+            self._put(key, msg.dir_, msg.uid, None)
+
+    def is_decided(self, msg):
+        """
+        ``True`` if ``msg`` is the canonical copy and the actions of its
+        current directory have already been applied to it.
+        """
+        _, entry = self._get(msg)
+        return (entry is not None and self._at(entry, msg.dir_, msg.uid)
+                and self._decided(entry) == msg.dir_)
+
+    def decided(self, msg, dir_, uid):
+        """
+        Record that actions of ``dir_`` have been applied to the message
+        that was at ``dir_``/``uid`` and is now ``msg``. Duplicates are not
+        recorded, and the entry is dropped if the new uid of ``msg`` is not
+        known.
+        """
+        key, entry = self._get(msg)
+        if key is None:
+            return
+        if entry is not None and not self._at(entry, dir_, uid):
+            return
+        if types.uid_key(msg.uid) is None:
+            self._drop(key)
+        else:
+            self._put(key, msg.dir_, msg.uid, dir_)
+
+    def reconcile(self, dir_, msg_ids):
+        """
+        Forget messages whose canonical copy was in ``dir_`` but is not
+        among ``msg_ids`` listed by :meth:`~.remote.Remote.list_messages`,
+        e.g. because another client deleted or moved it. The next copy seen
+        becomes the canonical one.
+        """
+        dir_id = self._dir_ids.get(dir_)
+        if dir_id is None:
+            return
+        present = set(_local(msg_id) for msg_id in msg_ids)
+        for entries in (self._recent, self._old):
+            gone = [key for key, entry in entries.items()
+                    if entry >> _LOCAL_BITS & _DIR_MASK == dir_id
+                    and entry & _LOCAL_MASK not in present]
+            for key in gone:
+                del entries[key]
+
+    def save(self):
+        """
+        Write the index to :attr:`path`.
+        """
+        if self.path is None:
+            return
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((self._dirs, self._recent, self._old), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
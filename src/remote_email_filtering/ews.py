@@ -0,0 +1,187 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+"""
+Exchange Web Services backend
+"""
+import logging
+
+import exchangelib
+import exchangelib.errors
+import imapclient.response_types
+
+from . import ratelimit, remote, types
+
+log = logging.getLogger(__name__)
+
+
+class Ews(remote.Remote):
+    THROTTLE_ERRORS = (
+        exchangelib.errors.ErrorServerBusy,
+        exchangelib.errors.ErrorTooManyObjectsOpened,
+        exchangelib.errors.RateLimitError,
+    )
+
+    def __init__(self, host, user, token, **kwargs):
+        super().__init__(token=token, **kwargs)
+        self.host = host
+        self.user = user
+        self.connect()
+
+    def connect(self):
+        self.connection = exchangelib.Account(
+            primary_smtp_address=self.user,
+            config=exchangelib.Configuration(
+                server=self.host,
+                credentials=exchangelib.OAuth2AuthorizationCodeCredentials(
+                    access_token=self.token.get()),
+                max_connections=self.rate_limiter.max_concurrency),
+            autodiscover=False,
+            access_type=exchangelib.DELEGATE)
+
+        self.toplevel = self.connection.msg_folder_root
+        # exchangelib creates sessions on demand, cap them at the current limit
+        self._pool_size = None
+        self._sync_pool()
+
+    def resize_pool(self, size):
+        protocol = self.connection.protocol
+        # Sessions are added lazily by Protocol.get_session up to this size,
+        # only sessions above it are closed here.
+        protocol._session_pool_maxsize = size
+        try:
+            while protocol.session_pool_size > size:
+                protocol.decrease_poolsize()
+        except exchangelib.errors.SessionPoolMinSizeReached:
+            pass
+
+    def disconnect(self):
+        try:
+            self.connection.protocol.close()
+        except Exception:
+            pass
+
+    def is_connection_error(self, exc):
+        return isinstance(exc, (exchangelib.errors.TransportError,
+                                exchangelib.errors.UnauthorizedError,
+                                OSError))
+
+    def throttle_hint(self, exc):
+        if not isinstance(exc, self.THROTTLE_ERRORS):
+            return None
+        # ErrorServerBusy carries the server's BackOffMilliseconds in seconds.
+        # RateLimitError only says how long exchangelib itself waited.
+        return ratelimit.Throttled(getattr(exc, 'back_off', None))
+
+    def _resolve_dir(self, parts):
+        start = self.connection.msg_folder_root
+        for part in parts:
+            start = start / part
+        return start
+
+    def _unresolve_dir(self, dir_obj):
+        toplevel_strip = len(self.toplevel.parts)
+        return tuple((x.name for x in dir_obj.parts[toplevel_strip:]))
+
+    def _resolve_msg_obj(self, msg_id):
+        dir_, msg_id = msg_id
+        dir_obj = self._resolve_dir(dir_)
+        msg = dir_obj.get(**msg_id)
+        return msg
+
+    @remote.remote_call
+    def is_dir_updated(self, dir_, watermark=None):
+        dir_ = self._resolve_dir(dir_)
+        sync = list(dir_.sync_items(only_fields=['id']))
+        return bool(sync), None
+
+    @remote.remote_call
+    def list_dirs(self):
+        toplevel_strip = len(self.toplevel.parts)
+        for dir_ in self.toplevel.walk():
+            yield self._unresolve_dir(dir_)
+
+    @remote.remote_call
+    def list_messages(self, dir_):
+        dir_obj = self._resolve_dir(dir_)
+        for msgid in dir_obj.all().values('id', 'changekey'):
+            yield (dir_, msgid)
+
+    @remote.remote_call
+    def fetch_envelope(self, msg_id):
+        msg = self._resolve_msg_obj(msg_id)
+        envelope = imapclient.response_types.Envelope(
+            date=msg.datetime_received,
+            subject=msg.subject.encode('utf-8'),
+            from_=tuple([types.Address.from_exchangelib(msg.author)]),
+            sender=(tuple([types.Address.from_exchangelib(msg.sender)])
+                    if msg.sender else None),
+            reply_to=tuple([types.Address.from_exchangelib(x) for x in
+                            (msg.reply_to if msg.reply_to else [])]),
+            to=tuple([types.Address.from_exchangelib(x) for x in
+                      (msg.to_recipients if msg.to_recipients else [])]),
+            cc=tuple([types.Address.from_exchangelib(x) for x in
+                      (msg.cc_recipients if msg.cc_recipients else [])]),
+            bcc=tuple([types.Address.from_exchangelib(x) for x in
+                       (msg.bcc_recipients if msg.bcc_recipients else [])]),
+            in_reply_to=msg.in_reply_to,
+            message_id=msg.message_id)
+        envelope.flags = self._flags(msg)
+        envelope.size = msg.size
+        return envelope
+
+    def fetch_multiple_envelopes(self, msg_ids):
+        for msg_id in msg_ids:
+            yield self.fetch_envelope(msg_id)
+
+    @remote.remote_call
+    def fetch_body(self, msg_id):
+        msg = self._resolve_msg_obj(msg_id)
+        return msg.mime_content
+
+    # EWS returns mime_content in a single response, so stream_body falls
+    # back to writing it out from memory one message at a time.
+
+    @remote.remote_call
+    def move_message_id(self, msg_id, target_dir):
+        msg = self._resolve_msg_obj(msg_id)
+        target = self._resolve_dir(target_dir)
+        msg.move(target)
+        return (self._unresolve_dir(msg.folder),
+                {'id': msg.id, 'changekey': msg.changekey})
+
+    FAKE_CATEGORIES = set([
+        r'\Seen',
+    ])
+
+    def _flags(self, msg):
+        flags = msg.categories
+        if flags is None:
+            flags = set()
+        else:
+            flags = set(flags)
+        if msg.is_read:
+            flags |= set([r'\Seen'])
+        return flags
+
+    @remote.remote_call
+    def fetch_flags(self, msg_id):
+        return self._flags(self._resolve_msg_obj(msg_id))
+
+    @remote.remote_call
+    def change_flags(self, msg_id, flags, op):
+        msg = self._resolve_msg_obj(msg_id)
+        existing = self.fetch_flags(msg_id)
+        new = op(existing, set(flags))
+        if new == existing:
+            return new
+
+        msg.is_read = r'\Seen' in new
+        msg.categories = list(new - self.FAKE_CATEGORIES)
+        msg.save()
+        return new
+
+    def add_flags(self, msg_id, flags):
+        return self.change_flags(msg_id, flags, op=lambda x, y: x | y)
+
+    def remove_flags(self, msg_id, flags):
+        return self.change_flags(msg_id, flags, op=lambda x, y: x - y)
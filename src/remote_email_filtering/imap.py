@@ -0,0 +1,280 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+"""
+IMAP backend
+"""
+import collections
+import io
+import itertools
+import logging
+import re
+import zlib
+
+import imapclient
+import imapclient.exceptions
+import imapclient.imapclient
+import imapclient.response_parser
+
+from . import ratelimit, remote
+
+log = logging.getLogger(__name__)
+
+imapclient.imaplib.Debug = 0
+
+
+class _InflatingReader(io.RawIOBase):
+    """
+    Raw stream that inflates RFC 4978 compressed data read from ``file``.
+    """
+    def __init__(self, file, metrics):
+        self.file = file
+        self.metrics = metrics
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            data = self.inflater.unconsumed_tail
+            if not data:
+                data = self.file.read1(io.DEFAULT_BUFFER_SIZE)
+                if not data:
+                    return 0
+                self.metrics['imap.compress.wire_in'] += len(data)
+            out = self.inflater.decompress(data, len(buf))
+            if out:
+                buf[:len(out)] = out
+                self.metrics['imap.compress.bytes_in'] += len(out)
+                return len(out)
+
+
+class Imap(remote.Remote):
+    # Response codes from RFC 5530 and Outlook's free-form back-off hint
+    THROTTLE_CODES = re.compile(rb'\[(THROTTLED|LIMIT|UNAVAILABLE|INUSE)\]')
+    THROTTLE_HINT = re.compile(rb'Backoff Time: (\d+) milliseconds')
+
+    def __init__(self, host, user, token, compress=False, pipeline_depth=1,
+                 pipeline_chunk=50, **kwargs):
+        """
+        :param bool compress: negotiate :rfc:`4978` ``COMPRESS=DEFLATE`` if
+           the server supports it
+        :param int pipeline_depth: number of ``UID FETCH`` commands kept in
+           flight at once when fetching many messages
+        :param int pipeline_chunk: number of messages per pipelined
+           ``UID FETCH``
+        """
+        super().__init__(token=token, **kwargs)
+        self.host = host
+        self.user = user
+        self.compress = compress
+        self.pipeline_depth = pipeline_depth
+        self.pipeline_chunk = pipeline_chunk
+        self.connect()
+
+    def connect(self):
+        self.connection = imapclient.IMAPClient(self.host)
+        self.connection.oauth2_login(self.user, access_token=self.token.get())
+        if (self.compress
+                and self.connection.has_capability('COMPRESS=DEFLATE')):
+            self._start_compression()
+
+    def _start_compression(self):
+        typ, data = self.connection._raw_command(b'COMPRESS', [b'DEFLATE'],
+                                                 uid=False)
+        self.connection._checkok('compress', typ, data)
+
+        imap = self.connection._imap
+        deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                    -zlib.MAX_WBITS)
+        sock = imap.sock
+        metrics = self.metrics
+
+        def send(data):
+            out = deflater.compress(data) + deflater.flush(zlib.Z_SYNC_FLUSH)
+            metrics['imap.compress.bytes_out'] += len(data)
+            metrics['imap.compress.wire_out'] += len(out)
+            sock.sendall(out)
+
+        imap.file = io.BufferedReader(_InflatingReader(imap.file, metrics))
+        imap.send = send
+        log.debug(f'COMPRESS=DEFLATE active on {self.host}')
+
+    def disconnect(self):
+        try:
+            self.connection.logout()
+        except (imapclient.exceptions.IMAPClientError, OSError):
+            pass
+
+    def is_connection_error(self, exc):
+        return isinstance(exc, (imapclient.exceptions.IMAPClientAbortError,
+                                OSError))
+
+    def throttle_hint(self, exc):
+        if not isinstance(exc, imapclient.exceptions.IMAPClientError):
+            return None
+        text = str(exc).encode('utf-8', errors='replace')
+        hint = self.THROTTLE_HINT.search(text)
+        if hint:
+            return ratelimit.Throttled(int(hint.group(1)) / 1000)
+        if self.THROTTLE_CODES.search(text):
+            return ratelimit.Throttled()
+        return None
+
+    @remote.remote_call
+    def is_dir_updated(self, dir_, watermark=None):
+        ret = self.connection.select_folder('/'.join(dir_))
+        new_watermark = (ret[b'UIDVALIDITY'], ret[b'UIDNEXT'])
+        return watermark != new_watermark, new_watermark
+
+    @remote.remote_call
+    def list_dirs(self):
+        for flags, delim, name in self.connection.list_folders():
+            name_components = tuple(name.split(delim.decode()))
+            yield name_components
+
+    @remote.remote_call
+    def list_messages(self, dir_):
+        self.connection.select_folder('/'.join(dir_))
+        for uid in self.connection.search():
+            # IMAP message uid are unique only within the directory. Create a
+            # composite uid that contains the directory.
+            yield (dir_, uid)
+
+    @remote.remote_call
+    def fetch_envelope(self, msg_id):
+        dir_, uid = msg_id
+        self.connection.select_folder('/'.join(dir_))
+        ret = self.connection.fetch(uid, ['UID', 'ENVELOPE'])
+        msg = ret[uid]
+        return msg[b'ENVELOPE']
+
+    def _fetch(self, uids, data):
+        """
+        ``UID FETCH`` ``data`` for ``uids`` in the selected folder, keeping
+        up to :attr:`pipeline_depth` chunks of :attr:`pipeline_chunk` messages
+        in flight.
+        """
+        if self.pipeline_depth <= 1 or len(uids) <= self.pipeline_chunk:
+            return self.connection.fetch(uids, data)
+
+        imap = self.connection._imap
+        items = imapclient.imapclient.seq_to_parenstr_upper(data)
+        pending = collections.deque()
+        ret = {}
+        try:
+            for i in range(0, len(uids), self.pipeline_chunk):
+                chunk = uids[i:i + self.pipeline_chunk]
+                pending.append(imap._command(
+                    'UID', 'FETCH',
+                    imapclient.imapclient.join_message_ids(chunk), items))
+                self.metrics['imap.pipelined_fetches'] += 1
+                if len(pending) >= self.pipeline_depth:
+                    self._complete_fetch(pending.popleft(), ret)
+            while pending:
+                self._complete_fetch(pending.popleft(), ret)
+        except Exception:
+            # Read the responses to commands still in flight so that they do
+            # not leak into the next command, e.g. the retry of this one.
+            while pending:
+                try:
+                    imap._command_complete('FETCH', pending.popleft())
+                except Exception:
+                    pass
+            imap.untagged_responses.pop('FETCH', None)
+            raise
+        return ret
+
+    def _complete_fetch(self, tag, ret):
+        imap = self.connection._imap
+        typ, data = imap._command_complete('FETCH', tag)
+        self.connection._checkok('fetch', typ, data)
+        # Responses to later commands in the pipeline may already have been
+        # read, they are keyed by UID so merging them early is harmless.
+        typ, data = imap._untagged_response(typ, data, 'FETCH')
+        ret.update(imapclient.response_parser.parse_fetch_response(
+            data, self.connection.normalise_times, True))
+
+    @remote.remote_call
+    def fetch_multiple_envelopes(self, msg_ids):
+        for dir_, uids in itertools.groupby(msg_ids, key=lambda uid: uid[0]):
+            self.connection.select_folder('/'.join(dir_))
+            local_uids = [uid[1] for uid in uids]
+            ret = self._fetch(local_uids,
+                              ['UID', 'ENVELOPE', 'FLAGS', 'RFC822.SIZE'])
+            for uid in local_uids:
+                envelope = ret[uid][b'ENVELOPE']
+                envelope.flags = set(ret[uid][b'FLAGS'])
+                envelope.size = ret[uid][b'RFC822.SIZE']
+                yield envelope
+
+    @remote.remote_call
+    def fetch_body(self, msg_id):
+        dir_, uid = msg_id
+        self.connection.select_folder('/'.join(dir_))
+        ret = self.connection.fetch(uid, ['UID', 'BODY.PEEK[]'])
+        msg = ret[uid]
+        return msg[b'BODY[]']
+
+    @remote.remote_call
+    def _fetch_partial(self, msg_id, offset, length):
+        dir_, uid = msg_id
+        self.connection.select_folder('/'.join(dir_))
+        ret = self.connection.fetch(
+            uid, ['UID', f'BODY.PEEK[]<{offset}.{length}>'])
+        return ret[uid][f'BODY[]<{offset}>'.encode('ascii')]
+
+    def stream_body(self, msg_id, fp, chunk_size=1 << 20):
+        # Partial fetches keep a single literal in memory at a time and each
+        # one is retried on its own after a reconnect. RFC822.SIZE is only
+        # approximate on some servers (e.g. Exchange), so read until the
+        # server returns a short chunk.
+        offset = 0
+        while True:
+            chunk = self._fetch_partial(msg_id, offset, chunk_size)
+            if not chunk:
+                return offset
+            fp.write(chunk)
+            offset += len(chunk)
+            if len(chunk) < chunk_size:
+                return offset
+
+    @remote.remote_call
+    def fetch_multiple_bodies(self, msg_ids):
+        for dir_, uids in itertools.groupby(msg_ids, key=lambda uid: uid[0]):
+            self.connection.select_folder('/'.join(dir_))
+            local_uids = [uid[1] for uid in uids]
+            ret = self._fetch(local_uids, ['UID', 'BODY.PEEK[]'])
+            yield from (ret[uid][b'BODY[]'] for uid in local_uids)
+
+    @remote.remote_call
+    def move_message_id(self, msg_id, target_dir):
+        dir_, uid = msg_id
+        self.connection.select_folder('/'.join(dir_))
+        untagged = self.connection._imap.untagged_responses
+        untagged.pop('COPYUID', None)
+        self.connection.move([uid], '/'.join(target_dir))
+        # UIDPLUS servers report COPYUID <uidvalidity> <old uids> <new uids>
+        copyuid = untagged.pop('COPYUID', None)
+        if not copyuid:
+            return (target_dir, None)
+        return (target_dir, int(copyuid[-1].split()[2]))
+
+    @remote.remote_call
+    def fetch_flags(self, msg_id):
+        dir_, uid = msg_id
+        self.connection.select_folder('/'.join(dir_))
+        flags = self.connection.get_flags([uid])
+        return set(flags[uid])
+
+    @remote.remote_call
+    def add_flags(self, msg_id, flags):
+        dir_, uid = msg_id
+        self.connection.select_folder('/'.join(dir_))
+        return set(self.connection.add_flags([uid], flags)[uid])
+
+    @remote.remote_call
+    def remove_flags(self, msg_id, flags):
+        dir_, uid = msg_id
+        self.connection.select_folder('/'.join(dir_))
+        return set(self.connection.remove_flags([uid], flags)[uid])
@@ -1,5 +1,6 @@
 # Copyright 2022, Gaurav Juvekar
 # SPDX-License-Identifier: MIT
+import collections
 import datetime
 import itertools
 import logging
@@ -8,33 +9,124 @@ import time
 import typing
 
 from . import types
+from .action import BatchAction
 
 log = logging.getLogger(__name__)
 
 
-def pipeline(message, actions):
-    actions = iter(actions)
+def _apply(profiler, action, remote, func, arg, messages=1):
+    if profiler is None:
+        return func(arg)
+    return profiler.call(action, remote, func, arg, messages)
+
+
+def _format_metrics(metrics):
+    """
+    Format the :attr:`~.remote.Remote.metrics` counted during a pass, with
+    the ratio of payload to wire bytes of IMAP compression.
+    """
+    ratios = []
+    for direction in ('in', 'out'):
+        wire = metrics[f'imap.compress.wire_{direction}']
+        if wire:
+            payload = metrics[f'imap.compress.bytes_{direction}']
+            ratios.append(f'compression {direction} {payload / wire:.2f}x')
+    return ', '.join([f'{dict(metrics)}'] + ratios)
+
+
+def _rooted(actions, root):
+    return zip(actions, itertools.repeat(root))
+
+
+def _advance(message, actions, profiler=None):
+    """
+    Apply per-message actions until ``actions`` are exhausted, the message is
+    stopped or a :class:`~.action.BatchAction` is reached. ``actions`` yields
+    ``(action, root)`` pairs, where ``root`` is the top-level action that
+    ``action`` was returned by, directly or indirectly. Returns the batch
+    action, its root and the remaining actions in the last case, ``None``
+    otherwise.
+    """
     while True:
         try:
-            action = next(actions)
+            action, root = next(actions)
         except StopIteration:
-            break
+            return None
+
+        if isinstance(action, BatchAction):
+            return action, root, actions
 
         action.remote = message.remote
         try:
-            further = action(message)
+            further = _apply(profiler, root, message.remote, action, message)
             if further is None:
-                raise Exception(msg=f'Action: {action} returned None')
+                raise Exception(f'Action: {action} returned None')
         except StopIteration:
-            return
-        actions = itertools.chain(further, actions)
+            return None
+        actions = itertools.chain(_rooted(further, root), actions)
+
+
+def pipeline_batch(messages, actions, profiler=None, stop_event=None):
+    """
+    Apply ``actions`` to each of ``messages``.
+
+    Per-message actions are applied to each message independently. A
+    :class:`~.action.BatchAction` is called once with all messages whose
+    pipelines reached it.
+
+    Returns the messages that not all actions were applied to because
+    ``stop_event`` was set.
+
+    :param profiler: a :class:`~.profiling.Profiler` to attribute the cost of
+       each of ``actions``, including the actions it returns, to
+    :param stop_event: Event object checked before advancing each message
+    """
+    # Top-level actions are their own roots
+    actions = [(action, action) for action in actions]
+    pending = [(message, iter(actions)) for message in messages]
+    while pending:
+        waiting = dict()
+        for i, (message, remaining) in enumerate(pending):
+            if stop_event is not None and stop_event.is_set():
+                return [message for message, _ in itertools.chain(
+                    pending[i:],
+                    *(entries for _, _, entries in waiting.values()))]
+            reached = _advance(message, remaining, profiler)
+            if reached is None:
+                continue
+            action, root, remaining = reached
+            waiting.setdefault(id(action), (action, root, []))[2].append(
+                (message, remaining))
+
+        pending = []
+        for action, root, entries in waiting.values():
+            action.remote = entries[0][0].remote
+            results = _apply(profiler, root, action.remote,
+                             action.process_batch,
+                             [message for message, _ in entries],
+                             messages=len(entries))
+            if results is None or len(results) != len(entries):
+                raise Exception(
+                    f'Action: {action} must return one result per message')
+            for (message, remaining), further in zip(entries, results):
+                pending.append((message, itertools.chain(
+                    _rooted(further, root), remaining)))
+    return []
+
+
+def pipeline(message, actions):
+    pipeline_batch([message], actions)
 
 
 def start(remote,
           dir_actions: typing.Dict[types.Directory, typing.List['Action']] = dict(),
           interval=datetime.timedelta(seconds=5),
           count=float('inf'),
-          stop_event=threading.Event()):
+          stop_event=threading.Event(),
+          parse_executor=None,
+          message_index=None,
+          metadata_index=None,
+          profiler=None):
     """
     Start applying :class:`~.action.Action` s to all messages in specified
     directories.
@@ -45,30 +137,85 @@ def start(remote,
     :param count: number of times to loop through all directories
     :param stop_event: Event object that safely exits from a loop before
     `count` expires
+    :param parse_executor: a :class:`~.parsing.ParseExecutor` that fetches
+       and parses message bodies of each batch in worker processes. Use it
+       when rules look at body text or attachments of most messages.
+    :param message_index: a :class:`~.dedup.MessageIndex` used to skip
+       messages that the actions of their directory have already been applied
+       to. Messages no longer listed in an updated directory are removed
+       from it. It is saved after every pass.
+    :param metadata_index: a :class:`~.metadata.MetadataIndex` kept up to
+       date with every message seen. Messages no longer listed in an updated
+       directory are removed from it. It is saved after every pass.
+    :param profiler: a :class:`~.profiling.Profiler` that reports the cost of
+       each action, including the requests it triggers, after profiled passes
     """
     watermarks = dict((k, None) for k in dir_actions.keys())
 
     while count > 0 and not stop_event.is_set():
-        for dir_ in remote.list_dirs():
-            if stop_event.is_set():
-                break
+        if profiler is not None:
+            profiler.start_pass()
+        # Metrics add up across passes, report the ones of this pass
+        metrics = collections.Counter(remote.metrics)
+        try:
+            for dir_ in remote.list_dirs():
+                if stop_event.is_set():
+                    break
 
-            if dir_ not in watermarks:
-                continue
+                if dir_ not in watermarks:
+                    continue
 
-            updated, new_watermark = remote.is_dir_updated(dir_,
-                                                           watermarks[dir_])
-            watermarks[dir_] = new_watermark
-            if not updated:
-                log.debug(f"No new messages in {dir_}")
-                continue
-            else:
-                log.debug(f"{dir_} has new messages")
+                updated, new_watermark = remote.is_dir_updated(
+                    dir_, watermarks[dir_])
+                watermarks[dir_] = new_watermark
+                if metadata_index is not None:
+                    metadata_index.update_watermark(dir_, new_watermark)
+                if not updated:
+                    log.debug(f"No new messages in {dir_}")
+                    continue
+                else:
+                    log.debug(f"{dir_} has new messages")
 
-            for message in remote.get_messages(dir_):
-                if stop_event.is_set():
-                    break
-                pipeline(message, dir_actions[dir_])
+                msg_ids = None
+                if message_index is not None or metadata_index is not None:
+                    msg_ids = list(remote.list_messages(dir_))
+                if message_index is not None:
+                    message_index.reconcile(dir_, msg_ids)
+                if metadata_index is not None:
+                    metadata_index.reconcile(dir_, msg_ids)
+
+                for batch in remote.get_message_batches(dir_, msg_ids):
+                    if stop_event.is_set():
+                        break
+                    locations = [(message.dir_, message.uid)
+                                 for message in batch]
+                    pending = batch
+                    if message_index is not None:
+                        pending = [message for message in batch
+                                   if not message_index.is_decided(message)]
+                    if parse_executor is not None:
+                        _apply(profiler, parse_executor, remote,
+                               parse_executor.parse_batch, pending,
+                               messages=len(pending))
+                    stopped = pipeline_batch(pending, dir_actions[dir_],
+                                             profiler, stop_event)
+                    stopped = set(id(message) for message in stopped)
+                    for message, (old_dir, old_uid) in zip(batch, locations):
+                        if (message_index is not None
+                                and id(message) not in stopped):
+                            message_index.decided(message, old_dir, old_uid)
+                        if metadata_index is not None:
+                            metadata_index.update(message, old_dir, old_uid)
 
+            if message_index is not None:
+                message_index.save()
+            if metadata_index is not None:
+                metadata_index.save()
+        finally:
+            # Stop cProfile and tracemalloc even if the pass failed
+            if profiler is not None:
+                profiler.finish_pass()
+        log.debug(f"Pass complete, limits {remote.rate_limiter.limits}, "
+                  f"metrics {_format_metrics(remote.metrics - metrics)}")
         count -= 1
         stop_event.wait(interval.seconds)
@@ -8,6 +8,17 @@ import typing
 from . import types
 
 
+def attachment_info(msg):
+    """
+    Name, content type and decoded size of each attachment of the
+    :class:`email.message.EmailMessage` ``msg``
+    """
+    return [{'name': attachment.get_filename(),
+             'content_type': attachment.get_content_type(),
+             'size': len(attachment.get_payload(decode=True) or b'')}
+            for attachment in msg.iter_attachments()]
+
+
 class Message(object):
     """
     An email message with convenient properties
@@ -28,11 +39,14 @@ class Message(object):
             self.envelope[field] = tuple((types.Address.from_imapclient(x)
                                           for x in self.envelope[field]))
 
-        self._flags = None
+        # Backends may fetch flags along with the envelope
+        self._flags = self.envelope.pop('flags', None)
         self.remote = remote
         self.dir_ = dir_
         self.raw = rfc822_bytes
         self._body = None
+        # Pieces of the body extracted by a parsing.ParseExecutor
+        self._extracted = None
         if rfc822_bytes is not None:
             self._body = email.message_from_bytes(self.raw,
                                                   policy=email.policy.default)
@@ -40,7 +54,8 @@ class Message(object):
     @property
     def body(self):
         if self._body is None:
-            self.raw = self.remote.fetch_body(self.uid)
+            if self.raw is None:
+                self.raw = self.remote.fetch_body(self.uid)
             self._body = email.message_from_bytes(self.raw,
                                                   policy=email.policy.default)
         return self._body
@@ -67,6 +82,14 @@ class Message(object):
     def Recipients(self):
         return self.To + self.Cc
 
+    @property
+    def Size(self):
+        """
+        Size of the full message in bytes, if the server reported it with
+        the envelope
+        """
+        return self.envelope.get('size')
+
     @property
     def Subject(self):
         return self.envelope['subject']
@@ -93,6 +116,8 @@ class Message(object):
 
     @property
     def BodyText(self):
+        if self._extracted is not None:
+            return self._extracted['text']
         body = self.body.get_body(preferencelist=('plain',))
         if not body:
             return None
@@ -105,3 +130,13 @@ class Message(object):
             yield {'name': attachment.get_filename(),
                    'content_type': attachment.get_content_type(),
                    'bytes': attachment.get_content()}
+
+    @property
+    def AttachmentInfo(self):
+        """
+        Name, content type and decoded size of each attachment, without
+        their contents
+        """
+        if self._extracted is not None:
+            return list(self._extracted['attachments'])
+        return attachment_info(self.body)
@@ -0,0 +1,308 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+"""
+Local index of message metadata, so that questions about the mailbox can be
+answered without scanning envelopes on the server again.
+"""
+import array
+import datetime
+import hashlib
+import itertools
+import logging
+import math
+import os
+import pickle
+
+from . import types
+
+log = logging.getLogger(__name__)
+
+
+def _subject_hash(subject):
+    if subject is None:
+        return 0
+    if isinstance(subject, str):
+        subject = subject.encode('utf-8', errors='replace')
+    return int.from_bytes(hashlib.blake2b(subject, digest_size=8).digest(),
+                          'little')
+
+
+def _timestamp(when):
+    if not isinstance(when, datetime.datetime):
+        return math.nan
+    return when.timestamp()
+
+
+class MetadataIndex(object):
+    """
+    Per-message date, size, flags, directory, sender host and mailbox and a
+    subject hash, stored in compact :mod:`array` columns with one row per
+    message.
+
+    Strings are interned into small integers and flags are stored as a
+    bitmask of the first 64 distinct flags seen. Unknown sizes are ``-1`` and
+    unknown flags ``-1``. Rows of deleted messages are tombstoned and reused.
+    Rows are also looked up by directory and local id (see
+    :func:`~.types.uid_key`).
+    """
+    def __init__(self, path=None):
+        """
+        :param str path: file to load the index from and :meth:`save` it to.
+           The index is kept in memory only if ``None``.
+        """
+        self.path = path
+        self.date = array.array('d')
+        self.size = array.array('q')
+        self.flags = array.array('q')
+        self.dir_ = array.array('L')
+        self.host = array.array('L')
+        self.mailbox = array.array('L')
+        self.subject = array.array('Q')
+        self.uids = []
+        self.live = bytearray()
+
+        self._strings = []
+        self._string_ids = dict()
+        self._flag_bits = dict()
+        self._rows = dict()
+        self._free = []
+        self.watermarks = dict()
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.__dict__.update(pickle.load(f))
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._rows.values())
+
+    def _intern(self, value):
+        if value not in self._string_ids:
+            self._string_ids[value] = len(self._strings)
+            self._strings.append(value)
+        return self._string_ids[value]
+
+    def _flag_mask(self, flags):
+        if flags is None:
+            return -1
+        mask = 0
+        for flag in flags:
+            if isinstance(flag, str):
+                flag = flag.encode('utf-8')
+            if flag not in self._flag_bits:
+                if len(self._flag_bits) >= 63:
+                    log.warning(f'Too many distinct flags, not indexing {flag}')
+                    continue
+                self._flag_bits[flag] = 1 << len(self._flag_bits)
+            mask |= self._flag_bits[flag]
+        return mask
+
+    def update(self, msg, dir_=None, uid=None):
+        """
+        Record the metadata of ``msg``. If it was at ``dir_``/``uid`` before
+        being moved, its old row is reused, or dropped if the new uid of
+        ``msg`` is not known.
+        """
+        local = types.uid_key(msg.uid)
+        if local is None:
+            if dir_ is not None:
+                self.remove(dir_, uid)
+            return
+        rows = self._rows.setdefault(msg.dir_, dict())
+        row = None
+        if dir_ is not None:
+            row = self._rows.get(dir_, {}).pop(types.uid_key(uid), None)
+        if row is None:
+            row = rows.get(local)
+
+        sender = msg.From[0] if msg.From else types.Address()
+        size = len(msg.raw) if msg.raw is not None else msg.Size
+        values = (
+            _timestamp(msg.Time),
+            -1 if size is None else size,
+            self._flag_mask(msg._flags),
+            self._intern(msg.dir_),
+            self._intern(sender.host),
+            self._intern(sender.mailbox),
+            _subject_hash(msg.Subject),
+        )
+        columns = (self.date, self.size, self.flags, self.dir_, self.host,
+                   self.mailbox, self.subject)
+
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                row = len(self.uids)
+                for column in columns:
+                    column.append(0)
+                self.uids.append(None)
+                self.live.append(0)
+        elif values[1] == -1 or values[2] == -1:
+            # Keep what is already known about the message
+            values = (values[0],
+                      values[1] if values[1] != -1 else self.size[row],
+                      values[2] if values[2] != -1 else self.flags[row],
+                      ) + values[3:]
+
+        for column, value in zip(columns, values):
+            column[row] = value
+        self.uids[row] = msg.uid
+        self.live[row] = 1
+        rows[local] = row
+
+    def _free_row(self, row):
+        self.live[row] = 0
+        self.uids[row] = None
+        self._free.append(row)
+
+    def remove(self, dir_, uid):
+        """
+        Forget the message at ``dir_``/``uid``.
+        """
+        row = self._rows.get(dir_, {}).pop(types.uid_key(uid), None)
+        if row is not None:
+            self._free_row(row)
+
+    def remove_dir(self, dir_):
+        """
+        Forget all messages in ``dir_``.
+        """
+        for row in self._rows.pop(dir_, {}).values():
+            self._free_row(row)
+
+    def reconcile(self, dir_, msg_ids):
+        """
+        Forget messages of ``dir_`` that are not among ``msg_ids`` listed by
+        :meth:`~.remote.Remote.list_messages`, e.g. because they were
+        deleted or moved by another client.
+        """
+        rows = self._rows.get(dir_)
+        if not rows:
+            return
+        present = set(types.uid_key(msg_id) for msg_id in msg_ids)
+        for local in [local for local in rows if local not in present]:
+            self._free_row(rows.pop(local))
+
+    def update_watermark(self, dir_, watermark):
+        """
+        Record the watermark of ``dir_`` from
+        :meth:`~.remote.Remote.is_dir_updated`. If the validity part of the
+        watermark (the IMAP ``UIDVALIDITY``) changes, uids in ``dir_`` are
+        no longer valid and its rows are dropped.
+        """
+        old = self.watermarks.get(dir_)
+        if (isinstance(old, tuple) and isinstance(watermark, tuple)
+                and old[0] != watermark[0]):
+            log.info(f'{dir_} UIDVALIDITY changed, dropping its metadata')
+            self.remove_dir(dir_)
+        self.watermarks[dir_] = watermark
+
+    def select(self, dir_=None, host=None, mailbox=None, since=None,
+               until=None, flags=(), without_flags=(), subject=None,
+               min_size=None):
+        """
+        Rows matching all of the given criteria.
+
+        :param tuple[str] dir_: in this directory
+        :param bytes host: sent from this host
+        :param bytes mailbox: sent from this mailbox
+        :param datetime since: dated at or after this time
+        :param datetime until: dated before this time
+        :param set[bytes] flags: with all of these flags
+        :param set[bytes] without_flags: with none of these flags. Messages
+           whose flags are unknown never match ``flags`` or
+           ``without_flags``.
+        :param bytes subject: with exactly this subject
+        :param int min_size: at least this many bytes
+        """
+        # Values never seen cannot match anything
+        wanted = []
+        for column, value in ((self.host, host), (self.mailbox, mailbox)):
+            if value is not None:
+                if value not in self._string_ids:
+                    return []
+                wanted.append((column, self._string_ids[value]))
+
+        with_mask = self._query_mask(flags)
+        without_mask = self._query_mask(without_flags, unknown_ok=True)
+        if with_mask is None:
+            return []
+
+        if dir_ is not None:
+            rows = sorted(self._rows.get(dir_, {}).values())
+        else:
+            rows = list(itertools.compress(range(len(self.live)), self.live))
+
+        # Filter one column at a time
+        for column, value in wanted:
+            rows = [row for row in rows if column[row] == value]
+        if subject is not None:
+            subject = _subject_hash(subject)
+            column = self.subject
+            rows = [row for row in rows if column[row] == subject]
+        if since is not None or until is not None:
+            since = -math.inf if since is None else since.timestamp()
+            until = math.inf if until is None else until.timestamp()
+            column = self.date
+            rows = [row for row in rows if since <= column[row] < until]
+        if flags or without_flags:
+            column = self.flags
+            rows = [row for row in rows
+                    if column[row] != -1
+                    and column[row] & with_mask == with_mask
+                    and not column[row] & without_mask]
+        if min_size is not None:
+            column = self.size
+            rows = [row for row in rows if column[row] >= min_size]
+        return rows
+
+    def _query_mask(self, flags, unknown_ok=False):
+        mask = 0
+        for flag in flags:
+            if isinstance(flag, str):
+                flag = flag.encode('utf-8')
+            if flag not in self._flag_bits:
+                if unknown_ok:
+                    continue
+                return None
+            mask |= self._flag_bits[flag]
+        return mask
+
+    def count(self, **criteria):
+        """
+        Number of messages matching ``criteria`` of :meth:`select`.
+        """
+        return len(self.select(**criteria))
+
+    def locations(self, **criteria):
+        """
+        ``(directory, uid)`` of messages matching ``criteria`` of
+        :meth:`select`.
+        """
+        return [(self._strings[self.dir_[row]], self.uids[row])
+                for row in self.select(**criteria)]
+
+    def oldest(self, **criteria):
+        """
+        ``(directory, uid)`` of the oldest dated message matching
+        ``criteria`` of :meth:`select`, or ``None``.
+        """
+        rows = [row for row in self.select(**criteria)
+                if not math.isnan(self.date[row])]
+        if not rows:
+            return None
+        row = min(rows, key=self.date.__getitem__)
+        return self._strings[self.dir_[row]], self.uids[row]
+
+    def save(self):
+        """
+        Write the index to :attr:`path`.
+        """
+        if self.path is None:
+            return
+        state = dict(self.__dict__)
+        del state['path']
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
@@ -0,0 +1,192 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+"""
+Parse message bodies in a pool of worker processes.
+
+Parsing MIME in pure Python is slow, so rules that look at
+:attr:`~.message.Message.BodyText` or
+:attr:`~.message.Message.AttachmentInfo` are CPU bound on a single core. A
+:class:`ParseExecutor` passed to :func:`~.main.start` fetches the bodies of
+each batch of messages up front and parses them in parallel. Only the pieces
+that rules need are sent back.
+"""
+import collections
+import concurrent.futures
+import email
+import email.policy
+import io
+import logging
+import multiprocessing.shared_memory
+import os
+
+from . import message
+
+log = logging.getLogger(__name__)
+
+
+def extract(fp) -> dict:
+    """
+    Parse the RFC 822 message in binary file ``fp`` and extract the plain
+    text body and attachment metadata.
+    """
+    msg = email.message_from_binary_file(fp, policy=email.policy.default)
+    body = msg.get_body(preferencelist=('plain',))
+    return {
+        'text': body.get_content() if body else None,
+        'attachments': message.attachment_info(msg),
+    }
+
+
+class _MemoryReader(io.RawIOBase):
+    """
+    Raw stream reading from a ``memoryview`` without copying it up front.
+    """
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        n = min(len(buf), len(self.view) - self.pos)
+        buf[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+def _extract_bytes(raw):
+    return extract(io.BytesIO(raw))
+
+
+def _extract_shared(name, size):
+    shm = multiprocessing.shared_memory.SharedMemory(name=name, track=False)
+    try:
+        view = shm.buf[:size]
+        try:
+            return extract(io.BufferedReader(_MemoryReader(view)))
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+
+class ParseExecutor(object):
+    """
+    Parses message bodies in a process pool.
+
+    Bodies are fetched and submitted a window at a time, and the number of
+    submissions and shared memory bytes in flight are bounded, so that memory
+    use does not grow with the size of a batch.
+    """
+    def __init__(self, max_workers=None, shm_threshold=1 << 20,
+                 max_pending=None, max_shm_bytes=1 << 28, keep_raw=True,
+                 mp_context=None):
+        """
+        :param int max_workers: number of worker processes, defaults to the
+           number of CPUs
+        :param int shm_threshold: bodies of at least this many bytes are
+           handed to workers through shared memory instead of being pickled
+        :param int max_pending: bodies fetched and submitted at a time,
+           defaults to twice the number of workers
+        :param int max_shm_bytes: shared memory in use at a time. A single
+           larger body is still parsed on its own.
+        :param bool keep_raw: keep the raw body in each
+           :class:`~.message.Message` after parsing. Otherwise it is dropped
+           and fetched again only if a rule needs the full
+           :attr:`~.message.Message.body`.
+        :param mp_context: a :mod:`multiprocessing` context for the pool
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.shm_threshold = shm_threshold
+        self.max_pending = max_pending or 2 * max_workers
+        self.max_shm_bytes = max_shm_bytes
+        self.keep_raw = keep_raw
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=mp_context)
+
+    def _submit(self, raw):
+        if len(raw) < self.shm_threshold:
+            return self.pool.submit(_extract_bytes, raw), None
+
+        shm = multiprocessing.shared_memory.SharedMemory(create=True,
+                                                         size=len(raw))
+        try:
+            shm.buf[:len(raw)] = raw
+            return self.pool.submit(_extract_shared, shm.name, len(raw)), shm
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+
+    def submit(self, raw: bytes) -> concurrent.futures.Future:
+        """
+        Schedule :func:`extract` of ``raw`` in a worker process.
+        """
+        future, shm = self._submit(raw)
+        if shm is not None:
+            def cleanup(_):
+                shm.close()
+                shm.unlink()
+
+            future.add_done_callback(cleanup)
+        return future
+
+    def _fetched(self, messages):
+        # Fetch bodies one window at a time, as they are submitted
+        for i in range(0, len(messages), self.max_pending):
+            window = messages[i:i + self.max_pending]
+            missing = [msg for msg in window if msg.raw is None]
+            if missing:
+                for msg, raw in zip(missing, missing[0].remote
+                                    .fetch_multiple_bodies(
+                                        [msg.uid for msg in missing])):
+                    msg.raw = raw
+            yield from window
+
+    def _collect(self, msg, future, shm):
+        try:
+            msg._extracted = future.result()
+            if not self.keep_raw:
+                msg.raw = None
+        except Exception:
+            # Leave it to Message to parse and raise in the rule that needs it
+            log.exception(f'Failed to parse {msg.dir_}/{msg.uid}')
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        return 0 if shm is None else shm.size
+
+    def parse_batch(self, messages):
+        """
+        Fetch the bodies of ``messages`` and parse them in the pool. Results
+        are attached to each :class:`~.message.Message`.
+        """
+        messages = [msg for msg in messages if msg._extracted is None]
+        pending = collections.deque()
+        shm_bytes = 0
+        try:
+            for msg in self._fetched(messages):
+                size = len(msg.raw)
+                if size < self.shm_threshold:
+                    size = 0
+                while pending and (len(pending) >= self.max_pending
+                                   or shm_bytes + size > self.max_shm_bytes):
+                    shm_bytes -= self._collect(*pending.popleft())
+                future, shm = self._submit(msg.raw)
+                pending.append((msg, future, shm))
+                shm_bytes += 0 if shm is None else shm.size
+        finally:
+            while pending:
+                self._collect(*pending.popleft())
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
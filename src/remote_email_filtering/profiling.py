@@ -0,0 +1,183 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+"""
+Opt-in profiling of :func:`~.main.start` passes.
+
+A :class:`Profiler` attributes wall and CPU time, memory allocations and the
+requests made to the :class:`~.remote.Remote` (e.g. lazy loads of
+:attr:`~.message.Message.body` or :attr:`~.message.Message.flags`) to each
+:class:`~.action.Action`, and writes a report ranking actions by cost after
+every profiled pass.
+"""
+import collections
+import cProfile
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+
+log = logging.getLogger(__name__)
+
+
+class _Cost(object):
+    __slots__ = ('calls', 'messages', 'wall', 'cpu', 'allocated', 'peak',
+                 'requests')
+
+    def __init__(self):
+        self.calls = 0
+        self.messages = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.allocated = 0
+        self.peak = 0
+        self.requests = collections.Counter()
+
+
+def describe(action):
+    """
+    A short human readable label for ``action``.
+    """
+    if hasattr(action, '__qualname__'):
+        return action.__qualname__
+    attrs = ', '.join(f'{k}={v!r}' for k, v in vars(action).items()
+                      if k != 'remote' and not k.startswith('_'))
+    label = f'{type(action).__qualname__}({attrs})'
+    if len(label) > 60:
+        label = label[:57] + '...'
+    return label
+
+
+class Profiler(object):
+    """
+    Collects per-action costs during :func:`~.main.start` passes.
+    """
+    def __init__(self, every=1, report=None, cprofile=True, memory=False,
+                 top=20):
+        """
+        :param int every: profile one pass out of this many
+        :param report: path of a file to append reports to, or a text file
+           object. Reports are logged if ``None``.
+        :param bool cprofile: include the functions with the most cumulative
+           time in the pass, from :mod:`cProfile`
+        :param bool memory: trace allocations with :mod:`tracemalloc`. This
+           slows down the pass considerably.
+        :param int top: number of :mod:`cProfile` entries to report
+        """
+        self.every = every
+        self.report = report
+        self.cprofile = cprofile
+        self.memory = memory
+        self.top = top
+
+        self.passes = 0
+        self.active = False
+        self.costs = dict()
+        self._profile = None
+        self._started = None
+        self._tracing = False
+
+    def start_pass(self):
+        self.active = self.passes % self.every == 0
+        self.passes += 1
+        if not self.active:
+            return
+        self.costs = dict()
+        self._started = time.perf_counter()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        if self.cprofile:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def call(self, action, remote, func, arg, messages=1):
+        """
+        Call ``func(arg)`` on behalf of ``action``, attributing its costs to
+        ``action``. :func:`~.main.start` passes the entry of its
+        ``dir_actions`` that the called action descends from, so that the
+        costs of follow-up actions add up to the rule that produced them.
+        """
+        if not self.active:
+            return func(arg)
+
+        cost = self.costs.get(id(action))
+        if cost is None:
+            cost = self.costs[id(action)] = (action, _Cost())
+        cost = cost[1]
+
+        requests = collections.Counter(getattr(remote, 'metrics', ()))
+        if self.memory:
+            tracemalloc.reset_peak()
+            allocated = tracemalloc.get_traced_memory()[0]
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            return func(arg)
+        finally:
+            cost.cpu += time.thread_time() - cpu
+            cost.wall += time.perf_counter() - wall
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                cost.allocated += current - allocated
+                cost.peak = max(cost.peak, peak - allocated)
+            cost.calls += 1
+            cost.messages += messages
+            cost.requests.update(
+                collections.Counter(getattr(remote, 'metrics', ()))
+                - requests)
+
+    def finish_pass(self):
+        if not self.active:
+            return
+        if self._profile is not None:
+            self._profile.disable()
+        if self._tracing:
+            # Leave tracing started by someone else running
+            tracemalloc.stop()
+            self._tracing = False
+        self.write_report()
+        self._profile = None
+        self.active = False
+
+    def ranked(self):
+        """
+        ``(action, cost)`` of the last profiled pass, most expensive first.
+        """
+        return sorted(self.costs.values(),
+                      key=lambda entry: (entry[1].wall, entry[1].cpu),
+                      reverse=True)
+
+    def format_report(self):
+        elapsed = time.perf_counter() - self._started
+        out = io.StringIO()
+        out.write(f'Pass {self.passes}: {elapsed:.3f}s\n')
+        out.write(f'{"wall s":>9} {"cpu s":>9} {"calls":>7} {"msgs":>7} '
+                  f'{"alloc KiB":>10} {"peak KiB":>9} {"requests":>8}  '
+                  f'action (requests by method)\n')
+        for action, cost in self.ranked():
+            methods = ', '.join(
+                f'{name.partition(".")[2]}={n}'
+                for name, n in sorted(cost.requests.items())
+                if name.startswith('requests.'))
+            out.write(f'{cost.wall:9.4f} {cost.cpu:9.4f} {cost.calls:7d} '
+                      f'{cost.messages:7d} {cost.allocated / 1024:10.1f} '
+                      f'{cost.peak / 1024:9.1f} '
+                      f'{cost.requests["requests"]:8d}  {describe(action)}'
+                      f'{f" ({methods})" if methods else ""}\n')
+        if self._profile is not None:
+            out.write('\n')
+            stats = pstats.Stats(self._profile, stream=out)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        return out.getvalue()
+
+    def write_report(self):
+        report = self.format_report()
+        if self.report is None:
+            log.info(report)
+        elif isinstance(self.report, str):
+            with open(self.report, 'a') as f:
+                f.write(report)
+        else:
+            self.report.write(report)
+            self.report.flush()
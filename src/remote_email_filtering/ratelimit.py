@@ -0,0 +1,159 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+"""
+Adaptive rate control for requests made to a :class:`~.remote.Remote`
+"""
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Throttled(Exception):
+    """
+    The server refused a request because too many were made.
+
+    :param float retry_after: seconds the server asked us to wait, if it
+       supplied a hint
+    """
+    def __init__(self, retry_after=None):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class RateLimiter(object):
+    """
+    Limits the request rate and the number of requests in flight to a server.
+
+    Limits grow additively on every successful request and shrink
+    multiplicatively whenever the server throttles us (AIMD). After a throttle
+    all requests are held back for a jittered exponential delay, or for the
+    delay the server asked for if it supplied one.
+
+    Use as a context manager around each request and report the outcome with
+    :meth:`success` or :meth:`throttled`.
+    """
+    def __init__(self, rate=10.0, min_rate=0.1, max_rate=100.0,
+                 concurrency=4, max_concurrency=16,
+                 batch_size=250, min_batch_size=10, max_batch_size=1000,
+                 decrease=0.5, base_delay=1.0, max_delay=300.0,
+                 max_retries=8):
+        """
+        :param float rate: initial requests per second
+        :param int concurrency: initial number of requests in flight
+        :param int batch_size: initial number of messages per batched request
+        :param float decrease: factor applied to all limits on throttling
+        :param float base_delay: first back-off delay in seconds when the
+           server gives no hint
+        :param float max_delay: longest back-off delay in seconds
+        :param int max_retries: consecutive throttles before giving up
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.decrease = decrease
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+
+        self.failures = 0
+        self._successes = 0
+        self._in_flight = 0
+        self._next_request = 0.0
+        self._backoff_until = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limits(self):
+        """
+        Current limits as a ``dict``
+        """
+        with self._cond:
+            return {
+                'rate': self.rate,
+                'concurrency': self.concurrency,
+                'batch_size': self.batch_size,
+                'backoff': max(0.0, self._backoff_until - time.monotonic()),
+            }
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = max(self._backoff_until, self._next_request) - now
+                if self._in_flight < self.concurrency and wait <= 0:
+                    break
+                self._cond.wait(timeout=wait if wait > 0 else None)
+            self._in_flight += 1
+            self._next_request = now + 1.0 / self.rate
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def success(self):
+        """
+        Additively increase limits after a request was accepted.
+        """
+        with self._cond:
+            self.failures = 0
+            self._successes += 1
+            self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+            if self._successes >= self.concurrency:
+                self._successes = 0
+                self.concurrency = min(self.max_concurrency,
+                                       self.concurrency + 1)
+                self.batch_size = min(self.max_batch_size,
+                                      self.batch_size + self.min_batch_size)
+            self._cond.notify_all()
+
+    def throttled(self, retry_after=None):
+        """
+        Multiplicatively decrease limits and back off after the server
+        throttled a request.
+
+        :param float retry_after: delay in seconds requested by the server
+        :returns: ``False`` if :attr:`max_retries` consecutive requests have
+           been throttled and the caller should give up
+        """
+        with self._cond:
+            self.failures += 1
+            self._successes = 0
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.concurrency = max(1, int(self.concurrency * self.decrease))
+            self.batch_size = max(self.min_batch_size,
+                                  int(self.batch_size * self.decrease))
+
+            if retry_after is not None:
+                # Honor the server's hint, spread a little so that parallel
+                # clients do not retry in lockstep.
+                delay = retry_after * random.uniform(1.0, 1.1)
+            else:
+                delay = random.uniform(
+                    0, min(self.max_delay,
+                           self.base_delay * 2 ** (self.failures - 1)))
+            self._backoff_until = max(self._backoff_until,
+                                      time.monotonic() + delay)
+            log.warning(f'Throttled, backing off {delay:.1f}s, '
+                        f'limits now {self.rate:.2f}/s x{self.concurrency} '
+                        f'batch {self.batch_size}')
+            self._cond.notify_all()
+            return self.failures <= self.max_retries
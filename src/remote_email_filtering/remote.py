@@ -1,24 +1,222 @@
 # Copyright 2022, Gaurav Juvekar
 # SPDX-License-Identifier: MIT
+"""
+The :class:`Remote` interface to a mail server and a registry of backends
+implementing it.
+
+Backends are imported only when they are looked up with :func:`get_backend`,
+so that a deployment pays only for the protocol library it uses.
+"""
 import abc
-import itertools
+import collections
+import functools
+import importlib
+import inspect
 import logging
+import threading
+import time
 import typing
 
-import exchangelib
-import imapclient
-import imapclient.response_types
-import oauthlib
-import oauthlib.oauth2
-
-from . import message, types
+from . import auth, message, ratelimit, types
 
 log = logging.getLogger(__name__)
 
-imapclient.imaplib.Debug = 0
+"""
+Entry point group that third party backends register their
+:class:`Remote` subclasses under
+"""
+ENTRY_POINT_GROUP = 'remote_email_filtering.backends'
+
+"""
+Backends shipped with this package, used when it is not installed with its
+entry points (e.g. run from a source checkout)
+"""
+BUILTIN_BACKENDS = {
+    'imap': 'remote_email_filtering.imap:Imap',
+    'ews': 'remote_email_filtering.ews:Ews',
+}
+
+_backends = {}
+
+
+def get_backend(name: str) -> typing.Type['Remote']:
+    """
+    Get the :class:`Remote` subclass registered as ``name``, importing its
+    module on first use.
+    """
+    if name in _backends:
+        return _backends[name]
+
+    import importlib.metadata
+    for entry_point in importlib.metadata.entry_points(
+            group=ENTRY_POINT_GROUP, name=name):
+        backend = entry_point.load()
+        break
+    else:
+        if name not in BUILTIN_BACKENDS:
+            raise KeyError(f'No backend named {name!r}')
+        module, _, attr = BUILTIN_BACKENDS[name].partition(':')
+        backend = getattr(importlib.import_module(module), attr)
+
+    _backends[name] = backend
+    return backend
+
+
+def __getattr__(name):
+    # Keep remote.Imap and remote.Ews working without importing both
+    if name in ('Imap', 'Ews'):
+        return get_backend(name.lower())
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def remote_call(func):
+    """
+    Run a :class:`Remote` method under its :attr:`~Remote.rate_limiter`.
+
+    Generator methods are drained inside the call so that their requests are
+    accounted for too.
+    """
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            yield from self._call(lambda: list(func(self, *args, **kwargs)),
+                                  func.__name__)
+    else:
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            return self._call(lambda: func(self, *args, **kwargs),
+                              func.__name__)
+    return wrapper
 
 
 class Remote(abc.ABC):
+    """
+    A mail server session.
+
+    Requests are retried transparently: throttled requests after backing off,
+    and requests that fail on a dropped connection or an expired access token
+    after reconnecting with a fresh token. Every backend method selects the
+    directory it works on, so a retried request resumes in the right place.
+    """
+    def __init__(self, token=None, rate_limiter=None, max_reconnects=5):
+        """
+        :param token: an access token or a token provider accepted by
+           :class:`~.auth.Token`, available to backends as ``self.token``
+        :param rate_limiter: a :class:`~.ratelimit.RateLimiter` shared by all
+           requests to this remote
+        :param int max_reconnects: consecutive reconnects attempted for a
+           single request before giving up
+        """
+        if rate_limiter is None:
+            rate_limiter = ratelimit.RateLimiter()
+        self.token = auth.Token(token)
+        self.rate_limiter = rate_limiter
+        self.max_reconnects = max_reconnects
+        self.metrics = collections.Counter()
+        self._local = threading.local()
+
+    @abc.abstractmethod
+    def connect(self):
+        """
+        Open a connection and authenticate with ``self.token``.
+        """
+        pass
+
+    @abc.abstractmethod
+    def disconnect(self):
+        """
+        Close the connection, ignoring errors from an already broken one.
+        """
+        pass
+
+    def reconnect(self, refresh=False):
+        """
+        Replace the connection with a new one.
+
+        :param bool refresh: refresh the access token even if it has not
+           expired yet
+        """
+        self.disconnect()
+        if refresh:
+            self.token.refresh()
+        self.connect()
+
+    def throttle_hint(self, exc: Exception
+                      ) -> typing.Optional[ratelimit.Throttled]:
+        """
+        Classify ``exc`` raised by the backend. Return a
+        :class:`~.ratelimit.Throttled` if the server is throttling us,
+        ``None`` otherwise.
+        """
+        return None
+
+    def resize_pool(self, size: int):
+        """
+        Resize the backend's connection pool, if it has one, to ``size``
+        connections. Called whenever the concurrency limit of
+        :attr:`rate_limiter` changes.
+        """
+        pass
+
+    def _sync_pool(self):
+        size = self.rate_limiter.concurrency
+        if size != getattr(self, '_pool_size', None):
+            self._pool_size = size
+            self.resize_pool(size)
+
+    def is_connection_error(self, exc: Exception) -> bool:
+        """
+        ``True`` if ``exc`` means that the connection or its authentication
+        is no longer usable.
+        """
+        return isinstance(exc, OSError)
+
+    def _call(self, func, name):
+        if getattr(self._local, 'in_call', False):
+            # Nested calls are covered by the outermost one
+            return func()
+
+        self._local.in_call = True
+        try:
+            return self._call_retrying(func, name)
+        finally:
+            self._local.in_call = False
+
+    def _call_retrying(self, func, name):
+        reconnects = 0
+        stale = self.token.expiring()
+        while True:
+            try:
+                if stale:
+                    log.info(f'Reconnecting to {self}')
+                    self.reconnect(refresh=reconnects > 0)
+                    stale = False
+                with self.rate_limiter:
+                    self.metrics['requests'] += 1
+                    self.metrics[f'requests.{name}'] += 1
+                    ret = func()
+            except Exception as e:
+                throttled = self.throttle_hint(e)
+                if throttled is not None:
+                    self.metrics['throttled'] += 1
+                    retry = self.rate_limiter.throttled(throttled.retry_after)
+                    self._sync_pool()
+                    if not retry:
+                        raise throttled from e
+                    continue
+                if (not self.is_connection_error(e)
+                        or reconnects >= self.max_reconnects):
+                    raise
+                reconnects += 1
+                self.metrics['reconnects'] += 1
+                log.warning(f'{name} failed with {e!r}, reconnecting')
+                time.sleep(min(2 ** (reconnects - 1), 60))
+                stale = True
+                continue
+            self.rate_limiter.success()
+            self._sync_pool()
+            return ret
+
     @abc.abstractmethod
     def is_dir_updated(self, dir_: types.Directory, watermark):
         """
@@ -65,25 +263,59 @@ class Remote(abc.ABC):
         """
         pass
 
+    def stream_body(self, msg_id: types.Uid, fp, chunk_size=1 << 20) -> int:
+        """
+        Write the full email body to binary file ``fp``, holding at most
+        about ``chunk_size`` bytes of it in memory if the backend allows.
+        Returns the number of bytes written.
+        """
+        body = memoryview(self.fetch_body(msg_id))
+        for offset in range(0, len(body), chunk_size):
+            fp.write(body[offset:offset + chunk_size])
+        return len(body)
+
+    def fetch_multiple_bodies(self, msg_ids: typing.Iterable[types.Uid]
+                              ) -> typing.Iterable[bytes]:
+        """
+        Fetch multiple full email bodies, attempting to batch them in least
+        possible requests.
+        """
+        for msg_id in msg_ids:
+            yield self.fetch_body(msg_id)
+
+    def get_message_batches(self, dir_: types.Directory, msg_ids=None
+                            ) -> typing.Iterable[typing.List[message.Message]]:
+        """
+        Get all messages in ``dir_`` in batches fetched together
+
+        :param msg_ids: uids already listed by :meth:`list_messages`
+        """
+        if msg_ids is None:
+            msg_ids = self.list_messages(dir_)
+        list_msg = list(msg_ids)
+        list_msg = list_msg[:250]
+        while list_msg:
+            batch_size = self.rate_limiter.batch_size
+            batch, list_msg = list_msg[:batch_size], list_msg[batch_size:]
+            yield [message.Message(
+                       uid=msg_id, envelope=envelope, dir_=dir_, remote=self)
+                   for msg_id, envelope in zip(
+                       batch, self.fetch_multiple_envelopes(batch))]
+
     def get_messages(self, dir_: types.Directory
                      ) -> typing.Iterable[message.Message]:
         """
         Get all messages in ``dir_``
         """
-        list_msg = list(self.list_messages(dir_))
-        list_msg = list_msg[:250]
-        for msg_id, envelope in zip(
-            list_msg, self.fetch_multiple_envelopes(list_msg)
-        ):
-            yield message.Message(
-                uid=msg_id, envelope=envelope, dir_=dir_, remote=self
-            )
+        for batch in self.get_message_batches(dir_):
+            yield from batch
 
     @abc.abstractmethod
     def move_message_id(self, msg_id: types.Uid, target_dir: types.Directory
                         ) -> types.Uid:
         """
-        Move ``msg_id`` to ``target_dir``.
+        Move ``msg_id`` to ``target_dir`` and return its new uid. The local
+        part of the uid is ``None`` if the server does not report it.
         """
         pass
 
@@ -119,184 +351,3 @@ class Remote(abc.ABC):
         Remove flags associated with a ``msg_id``
         """
         pass
-
-
-class Imap(Remote):
-    def __init__(self, host, user, token, **kwargs):
-        super().__init__(**kwargs)
-        self.connection = imapclient.IMAPClient(host)
-        self.connection.oauth2_login(user, access_token=token)
-
-    def is_dir_updated(self, dir_, watermark=None):
-        ret = self.connection.select_folder('/'.join(dir_))
-        new_watermark = (ret[b'UIDVALIDITY'], ret[b'UIDNEXT'])
-        return watermark != new_watermark, new_watermark
-
-    def list_dirs(self):
-        for flags, delim, name in self.connection.list_folders():
-            name_components = tuple(name.split(delim.decode()))
-            yield name_components
-
-    def list_messages(self, dir_):
-        self.connection.select_folder('/'.join(dir_))
-        for uid in self.connection.search():
-            # IMAP message uid are unique only within the directory. Create a
-            # composite uid that contains the directory.
-            yield (dir_, uid)
-
-    def fetch_envelope(self, msg_id):
-        dir_, uid = msg_id
-        self.connection.select_folder('/'.join(dir_))
-        ret = self.connection.fetch(uid, ['UID', 'ENVELOPE'])
-        msg = ret[uid]
-        return msg[b'ENVELOPE']
-
-    def fetch_multiple_envelopes(self, msg_ids):
-        for dir_, uids in itertools.groupby(msg_ids, key=lambda uid: uid[0]):
-            self.connection.select_folder('/'.join(dir_))
-            local_uids = [uid[1] for uid in uids]
-            ret = self.connection.fetch(local_uids, ['UID', 'ENVELOPE'])
-            yield from (ret[uid][b'ENVELOPE'] for uid in local_uids)
-
-    def fetch_body(self, msg_id):
-        dir_, uid = msg_id
-        self.connection.select_folder('/'.join(dir_))
-        ret = self.connection.fetch(uid, ['UID', 'BODY.PEEK[]'])
-        msg = ret[uid]
-        return msg[b'BODY[]']
-
-    def move_message_id(self, msg_id, target_dir):
-        dir_, uid = msg_id
-        self.connection.select_folder('/'.join(dir_))
-        self.connection.move([uid], '/'.join(target_dir))
-        return (target_dir, uid)
-
-    def fetch_flags(self, msg_id):
-        dir_, uid = msg_id
-        self.connection.select_folder('/'.join(dir_))
-        flags = self.connection.get_flags([uid])
-        return set(flags[uid])
-
-    def add_flags(self, msg_id, flags):
-        dir_, uid = msg_id
-        self.connection.select_folder('/'.join(dir_))
-        return set(self.connection.add_flags([uid], flags)[uid])
-
-    def remove_flags(self, msg_id, flags):
-        dir_, uid = msg_id
-        self.connection.select_folder('/'.join(dir_))
-        return set(self.connection.remove_flags([uid], flags)[uid])
-
-
-class Ews(Remote):
-    def __init__(self, host, user, token, **kwargs):
-        super().__init__(**kwargs)
-
-        self.connection = exchangelib.Account(
-            primary_smtp_address=user,
-            config=exchangelib.Configuration(
-                server=host,
-                credentials=exchangelib.OAuth2AuthorizationCodeCredentials(access_token=token)),
-            autodiscover=False,
-            access_type=exchangelib.DELEGATE)
-
-        self.toplevel = self.connection.msg_folder_root
-
-    def _resolve_dir(self, parts):
-        start = self.connection.msg_folder_root
-        for part in parts:
-            start = start / part
-        return start
-
-    def _unresolve_dir(self, dir_obj):
-        toplevel_strip = len(self.toplevel.parts)
-        return tuple((x.name for x in dir_obj.parts[toplevel_strip:]))
-
-    def _resolve_msg_obj(self, msg_id):
-        dir_, msg_id = msg_id
-        dir_obj = self._resolve_dir(dir_)
-        msg = dir_obj.get(**msg_id)
-        return msg
-
-    def is_dir_updated(self, dir_, watermark=None):
-        dir_ = self._resolve_dir(dir_)
-        sync = list(dir_.sync_items(only_fields=['id']))
-        return bool(sync), None
-
-    def list_dirs(self):
-        toplevel_strip = len(self.toplevel.parts)
-        for dir_ in self.toplevel.walk():
-            yield self._unresolve_dir(dir_)
-
-    def list_messages(self, dir_):
-        dir_obj = self._resolve_dir(dir_)
-        for msgid in dir_obj.all().values('id', 'changekey'):
-            yield (dir_, msgid)
-
-    def fetch_envelope(self, msg_id):
-        msg = self._resolve_msg_obj(msg_id)
-        envelope = imapclient.response_types.Envelope(
-            date=msg.datetime_received,
-            subject=msg.subject.encode('utf-8'),
-            from_=tuple([types.Address.from_exchangelib(msg.author)]),
-            sender=(tuple([types.Address.from_exchangelib(msg.sender)])
-                    if msg.sender else None),
-            reply_to=tuple([types.Address.from_exchangelib(x) for x in
-                            (msg.reply_to if msg.reply_to else [])]),
-            to=tuple([types.Address.from_exchangelib(x) for x in
-                      (msg.to_recipients if msg.to_recipients else [])]),
-            cc=tuple([types.Address.from_exchangelib(x) for x in
-                      (msg.cc_recipients if msg.cc_recipients else [])]),
-            bcc=tuple([types.Address.from_exchangelib(x) for x in
-                       (msg.bcc_recipients if msg.bcc_recipients else [])]),
-            in_reply_to=msg.in_reply_to,
-            message_id=msg.message_id)
-        return envelope
-
-    def fetch_multiple_envelopes(self, msg_ids):
-        for msg_id in msg_ids:
-            yield self.fetch_envelope(msg_id)
-
-    def fetch_body(self, msg_id):
-        msg = self._resolve_msg_obj(msg_id)
-        return msg.mime_content
-
-    def move_message_id(self, msg_id, target_dir):
-        msg = self._resolve_msg_obj(msg_id)
-        target = self._resolve_dir(target_dir)
-        msg.move(target)
-        return (self._unresolve_dir(msg.folder),
-                {'id': msg.id, 'changekey': msg.changekey})
-
-    FAKE_CATEGORIES = set([
-        r'\Seen',
-    ])
-
-    def fetch_flags(self, msg_id):
-        msg = self._resolve_msg_obj(msg_id)
-        flags = msg.categories
-        if flags is None:
-            flags = set()
-        else:
-            flags = set(flags)
-        if msg.is_read:
-            flags |= set([r'\Seen'])
-        return flags
-
-    def change_flags(self, msg_id, flags, op):
-        msg = self._resolve_msg_obj(msg_id)
-        existing = self.fetch_flags(msg_id)
-        new = op(existing, set(flags))
-        if new == existing:
-            return new
-
-        msg.is_read = r'\Seen' in new
-        msg.categories = list(new - self.FAKE_CATEGORIES)
-        msg.save()
-        return new
-
-    def add_flags(self, msg_id, flags):
-        return self.change_flags(msg_id, flags, op=lambda x, y: x | y)
-
-    def remove_flags(self, msg_id, flags):
-        return self.change_flags(msg_id, flags, op=lambda x, y: x - y)
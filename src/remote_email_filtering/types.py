@@ -43,3 +43,16 @@ A directory on the mail server made up of the path components of the directory
 Directory = typing.Tuple[str]
 
 Uid = typing.Hashable
+
+
+def uid_key(uid):
+    """
+    The part of a ``(directory, local id)`` :data:`Uid` that identifies a
+    message for as long as it stays in its directory: the IMAP uid, or the
+    EWS item id without its changekey, which changes whenever the item is
+    modified.
+    """
+    _, local = uid
+    if isinstance(local, dict):
+        return local['id']
+    return local
@@ -0,0 +1,37 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+import os
+import tempfile
+import types
+import unittest
+
+from remote_email_filtering import archive
+
+
+class MaildirTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.maildir = archive.Maildir(tmp.name)
+        self.new = os.path.join(tmp.name, 'new')
+        self.tmp = os.path.join(tmp.name, 'tmp')
+
+    def test_batch_is_visible_at_the_end(self):
+        with self.maildir.batch() as add:
+            for i in range(3):
+                add(types.SimpleNamespace(raw=b'Subject: %d\r\n\r\n' % i))
+                self.assertEqual(os.listdir(self.new), [])
+        self.assertEqual(len(os.listdir(self.new)), 3)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_failed_batch_is_discarded(self):
+        with self.assertRaises(RuntimeError):
+            with self.maildir.batch() as add:
+                add(types.SimpleNamespace(raw=b'Subject: 1\r\n\r\n'))
+                raise RuntimeError()
+        self.assertEqual(os.listdir(self.new), [])
+        self.assertEqual(os.listdir(self.tmp), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
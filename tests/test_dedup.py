@@ -0,0 +1,49 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+import types
+import unittest
+
+from remote_email_filtering import dedup
+
+INBOX = ('INBOX',)
+LISTS = ('Lists',)
+
+
+def message(dir_, local, message_id=b'<1@example.com>'):
+    return types.SimpleNamespace(dir_=dir_, uid=(dir_, local),
+                                 envelope={'message_id': message_id})
+
+
+class MessageIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = dedup.MessageIndex()
+
+    def test_copy_is_duplicate(self):
+        self.index.claim(message(INBOX, 1))
+        self.assertFalse(self.index.is_duplicate(message(INBOX, 1)))
+        self.assertTrue(self.index.is_duplicate(message(LISTS, 7)))
+        self.assertEqual(self.index.location(message(LISTS, 7)), INBOX)
+
+    def test_changekey_is_ignored(self):
+        self.index.claim(message(INBOX, {'id': 'A', 'changekey': '1'}))
+        self.assertFalse(self.index.is_duplicate(
+            message(INBOX, {'id': 'A', 'changekey': '2'})))
+
+    def test_reconcile_forgets_deleted_canonical_copy(self):
+        self.index.claim(message(INBOX, 1))
+        self.index.claim(message(INBOX, 2, b'<2@example.com>'))
+        self.index.reconcile(INBOX, [(INBOX, 2)])
+        self.assertFalse(self.index.is_duplicate(message(LISTS, 7)))
+        self.assertEqual(len(self.index), 1)
+
+    def test_eviction(self):
+        index = dedup.MessageIndex(max_entries=4)
+        for i in range(10):
+            index.claim(message(INBOX, i, b'<%d@example.com>' % i))
+        self.assertLessEqual(len(index), 4)
+        self.assertIsNotNone(index.location(
+            message(INBOX, 9, b'<9@example.com>')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+import unittest
+import unittest.mock
+
+try:
+    import exchangelib.errors
+    import exchangelib.protocol
+
+    from remote_email_filtering import ews
+except ImportError:
+    ews = None
+
+from remote_email_filtering import ratelimit
+
+
+@unittest.skipIf(ews is None, 'exchangelib is not installed')
+class ThrottleHintTest(unittest.TestCase):
+    def setUp(self):
+        # throttle_hint does not touch the connection
+        self.remote = ews.Ews.__new__(ews.Ews)
+
+    def test_rate_limit_error(self):
+        exc = exchangelib.errors.RateLimitError(
+            'Max timeout reached', url='https://example.com/EWS/Exchange.asmx',
+            status_code=503, total_wait=300)
+        hint = self.remote.throttle_hint(exc)
+        self.assertIsInstance(hint, ratelimit.Throttled)
+        self.assertIsNone(hint.retry_after)
+
+    def test_server_busy(self):
+        exc = exchangelib.errors.ErrorServerBusy('Server busy', back_off=2.5)
+        self.assertEqual(self.remote.throttle_hint(exc).retry_after, 2.5)
+
+    def test_other_error(self):
+        self.assertIsNone(self.remote.throttle_hint(ValueError()))
+
+
+@unittest.skipIf(ews is None, 'exchangelib is not installed')
+class ResizePoolTest(unittest.TestCase):
+    def test_sessions_are_not_created_up_front(self):
+        config = exchangelib.Configuration(
+            server='example.com', max_connections=8,
+            credentials=exchangelib.OAuth2AuthorizationCodeCredentials(
+                access_token={'access_token': 'token',
+                              'token_type': 'Bearer'}))
+        remote = ews.Ews.__new__(ews.Ews)
+        remote.connection = unittest.mock.Mock()
+        remote.connection.protocol = exchangelib.protocol.Protocol(
+            config=config)
+        remote.resize_pool(4)
+        self.assertEqual(remote.connection.protocol.session_pool_size, 0)
+        self.assertEqual(remote.connection.protocol._session_pool_maxsize, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# Copyright 2022, Gaurav Juvekar
+# SPDX-License-Identifier: MIT
+import io
+import re
+import unittest
+import unittest.mock
+
+try:
+    from remote_email_filtering import imap
+except ImportError:
+    imap = None
+
+from remote_email_filtering import remote
+
+
+@unittest.skipIf(imap is None, 'imapclient is not installed')
+class StreamBodyTest(unittest.TestCase):
+    BODY = b'x' * 2500
+
+    def setUp(self):
+        self.remote = imap.Imap.__new__(imap.Imap)
+        remote.Remote.__init__(self.remote)
+        self.remote.connection = unittest.mock.Mock()
+        self.remote.connection.fetch.side_effect = self.fetch
+
+    def fetch(self, uid, items):
+        offset, length = map(int, re.search(r'<(\d+)\.(\d+)>',
+                                            items[1]).groups())
+        return {uid: {f'BODY[]<{offset}>'.encode('ascii'):
+                      self.BODY[offset:offset + length]}}
+
+    def test_reads_past_approximate_size(self):
+        # Nothing asks for RFC822.SIZE, which Exchange reports approximately
+        for chunk_size in (500, 1000, 2500, 4096):
+            fp = io.BytesIO()
+            written = self.remote.stream_body((('INBOX',), 1), fp, chunk_size)
+            self.assertEqual(written, len(self.BODY))
+            self.assertEqual(fp.getvalue(), self.BODY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Measure the cost of importing remote_email_filtering with each backend.
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), '../src'))
+
+SNIPPET = '''
+import resource, time
+start = time.perf_counter()
+import remote_email_filtering.remote
+{load}
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def measure(load, repeat):
+    env = dict(os.environ, PYTHONPATH=SRC)
+    times, rss = [], []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', SNIPPET.format(load=load)],
+                             env=env, check=True, capture_output=True,
+                             text=True).stdout.split()
+        times.append(float(out[0]))
+        rss.append(int(out[1]))
+    return statistics.median(times), max(rss)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of fresh interpreters per measurement")
+    parser.add_argument("BACKEND", nargs='*', default=['imap', 'ews'])
+    args = parser.parse_args()
+
+    cases = [('base', '')] + [
+        (name, f'remote_email_filtering.remote.get_backend({name!r})')
+        for name in args.BACKEND]
+    for name, load in cases:
+        elapsed, rss = measure(load, args.repeat)
+        print(f'{name:>8}: {elapsed * 1000:8.1f} ms  {rss / 1024:8.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -32,9 +32,8 @@ def main():
     args = parser.parse_args()
     creds = json.loads(args.ACCESS_TOKEN.read())
 
-    remote = remote_email_filtering.remote.Imap(host=args.HOST,
-                                                user=args.USER,
-                                                token=creds['token'])
+    Imap = remote_email_filtering.remote.get_backend('imap')
+    remote = Imap(host=args.HOST, user=args.USER, token=creds['token'])
     filters = {
         ('INBOX',): [print_envelope, Stop()],
     }
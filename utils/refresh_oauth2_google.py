@@ -17,6 +17,25 @@ def refresh(secrets, not_after=datetime.datetime.now(datetime.timezone.utc)):
     return json.loads(credentials.to_json())
 
 
+def token_provider(path, validity=datetime.timedelta(minutes=30)):
+    """
+    Returns a token provider for a Remote that refreshes the authorized
+    secrets file at path in-place.
+    """
+    def provider():
+        with open(path, 'r') as f:
+            secrets = json.load(f)
+        output = refresh(secrets,
+                         not_after=(datetime.datetime.now(datetime.timezone.utc)
+                                    + validity))
+        if output is not None:
+            with open(path, 'w') as f:
+                f.write(json.dumps(output))
+            secrets = output
+        return secrets['token'], dateparser.parse(secrets['expiry'])
+    return provider
+
+
 def main():
     import argparse
 